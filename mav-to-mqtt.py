@@ -6,6 +6,7 @@ Simple MAVLink -> MQTT bridge for PX4 SITL.
 
 Requirements:
     pip install paho-mqtt pymavlink
+    mypyc telemetry_build.py   # optional, compiles the payload builders (pip install mypy)
 
 Usage examples:
   # publish to local broker (or SSH-forwarded local port)
@@ -17,22 +18,33 @@ Usage examples:
   # set lower publish rate (Hz)
   python3 mav_to_mqtt.py --rate 2
 
+  # publish up to 10 samples per MQTT message as a JSON array, flushing at least every 500 ms
+  python3 mav_to_mqtt.py --rate 20 --batch 10 --batch-ms 500
+
+  # lowest-overhead decoding on a local SITL link (skips pymavlink parsing and CRC checks)
+  python3 mav_to_mqtt.py --mav udp:127.0.0.1:14550 --raw-udp
+
 Notes:
 - Do NOT commit credentials. Use files or env vars and .gitignore them.
 - If using TLS, pass --tls-ca, --tls-cert, --tls-key.
 """
 
 import argparse
-import json
+import functools
+import logging
 import time
 import sys
-import threading
+import selectors
 import signal
-from queue import Queue, Empty
+import socket
+from collections import deque
 
 import paho.mqtt.client as mqtt
 from pymavlink import mavutil
 
+# builders live in their own module so they can be compiled with mypyc
+from telemetry_build import TELEMETRY_TYPES, build_telemetry_from_msg, decode_datagram
+
 # -----------------------
 # Helper / defaults
 # -----------------------
@@ -40,63 +52,29 @@ DEFAULT_MAV_URI = "udp:127.0.0.1:14550"
 DEFAULT_MQTT_HOST = "localhost"
 DEFAULT_MQTT_PORT = 1883
 DEFAULT_TOPIC = "drone/telemetry"
-DEFAULT_RATE = 5.0  # Hz (max publish rate)
+DEFAULT_RATE = 5.0  # Hz (stream rate requested per message type)
+MQTT_SNDBUF = 256 * 1024  # bytes, room for bursts/batches without blocking publish
+RECONNECT_MIN_DELAY = 1  # s, broker reconnect backoff
+RECONNECT_MAX_DELAY = 8
+STATUS_EVERY = 50  # samples between INFO status lines (per-sample lines are DEBUG, see -v)
+MAX_DRAIN = 64  # datagrams/messages read per wakeup before the broker socket gets a turn
+
+log = logging.getLogger("mav_to_mqtt")
 
 # -----------------------
-# MAVLink -> JSON builder
+# MAVLink message ids
 # -----------------------
-def build_telemetry_from_msg(msg, seq):
-    """Return dict or None if msg not relevant."""
-    t = {"seq": seq, "timestamp": time.time()}
-    mt = msg.get_type()
-    if mt == "GLOBAL_POSITION_INT":
-        # lat/lon are integers scaled by 1e7; alt in mm
-        try:
-            t.update({
-                "lat": msg.lat / 1e7,
-                "lon": msg.lon / 1e7,
-                "alt": msg.alt / 1000.0,         # m
-                "relative_alt": getattr(msg, "relative_alt", None) / 1000.0 if getattr(msg, "relative_alt", None) is not None else None,
-                "vx": getattr(msg, "vx", None),  # cm/s
-                "vy": getattr(msg, "vy", None),
-                "vz": getattr(msg, "vz", None),
-                "hdg": getattr(msg, "hdg", None) / 100.0 if getattr(msg, "hdg", None) is not None else None
-            })
-        except Exception:
-            return None
-    elif mt == "VFR_HUD":
-        # alt in m, ground speed m/s, heading deg
-        try:
-            t.update({
-                "velocity": getattr(msg, "vel", None),  # m/s
-                "alt": getattr(msg, "alt", None),       # m
-                "airspeed": getattr(msg, "airspeed", None),
-                "groundspeed": getattr(msg, "groundspeed", None),
-                "throttle": getattr(msg, "throttle", None)
-            })
-        except Exception:
-            return None
-    elif mt == "GPS_RAW_INT":
-        try:
-            t.update({
-                "lat": msg.lat / 1e7,
-                "lon": msg.lon / 1e7,
-                "alt": msg.alt / 1000.0,
-                "eph": getattr(msg, "eph", None),
-                "epv": getattr(msg, "epv", None),
-            })
-        except Exception:
-            return None
-    else:
-        return None
-    # Normalize — remove None entries to keep JSON small
-    return {k: v for k, v in t.items() if v is not None}
+TELEMETRY_MSG_IDS = (
+    mavutil.mavlink.MAVLINK_MSG_ID_GLOBAL_POSITION_INT,
+    mavutil.mavlink.MAVLINK_MSG_ID_VFR_HUD,
+    mavutil.mavlink.MAVLINK_MSG_ID_GPS_RAW_INT,
+)
 
 # -----------------------
 # MQTT helper
 # -----------------------
 class MQTTClient:
-    def __init__(self, host, port, username=None, password=None, tls_ca=None, tls_cert=None, tls_key=None, client_id="mav_to_mqtt"):
+    def __init__(self, host, port, username=None, password=None, tls_ca=None, tls_cert=None, tls_key=None, client_id="mav_to_mqtt", queue_size=200):
         self.host = host
         self.port = port
         self.username = username
@@ -104,7 +82,7 @@ class MQTTClient:
         self.tls_ca = tls_ca
         self.tls_cert = tls_cert
         self.tls_key = tls_key
-        self.client = mqtt.Client(client_id)
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=client_id)
         if username:
             self.client.username_pw_set(username, password)
         if tls_ca:
@@ -112,136 +90,290 @@ class MQTTClient:
             self.client.tls_set(ca_certs=tls_ca, certfile=tls_cert, keyfile=tls_key)
         self.client.on_connect = self.on_connect
         self.client.on_disconnect = self.on_disconnect
-        self._connected = threading.Event()
+        # socket I/O is driven by the bridge's selector (see start()), not a paho thread
+        self.client.on_socket_open = self._on_socket_open
+        self.client.on_socket_close = self._on_socket_close
+        self.client.on_socket_register_write = self._on_socket_register_write
+        self.client.on_socket_unregister_write = self._on_socket_unregister_write
+        # the only offline buffer (publish() never hands paho a message while disconnected):
+        # samples published while the broker is unreachable; full deque drops the oldest
+        self._backlog = deque(maxlen=queue_size)
+        self.connected = False
+        self._sel = None
+        self._retry_delay = RECONNECT_MIN_DELAY
+        self._retry_at = 0.0
         self._stop = False
 
-    def on_connect(self, client, userdata, flags, rc):
-        if rc == 0:
-            print("[mqtt] connected")
-            self._connected.set()
+    def on_connect(self, client, userdata, flags, reason_code, properties):
+        if reason_code.is_failure:
+            log.warning("[mqtt] connect refused: %s (retry in %ds)", reason_code, self._retry_delay)
+            self._backoff()
         else:
-            print(f"[mqtt] connect failed rc={rc}")
+            log.info("[mqtt] connected")
+            self._tune_socket(client.socket())
+            self.connected = True
+            self._retry_delay = RECONNECT_MIN_DELAY
 
-    def on_disconnect(self, client, userdata, rc):
-        print("[mqtt] disconnected")
-        self._connected.clear()
+    @staticmethod
+    def _tune_socket(sock):
+        # small JSON packets: send immediately instead of waiting on Nagle/delayed-ACK
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, MQTT_SNDBUF)
+        except (OSError, AttributeError) as e:
+            # e.g. websocket transport -- not fatal, just slower
+            log.warning("[mqtt] could not tune socket: %s", e)
+
+    def on_disconnect(self, client, userdata, disconnect_flags, reason_code, properties):
+        log.info("[mqtt] disconnected: %s", reason_code)
+        self.connected = False
+        # also covers a TCP connect that never got a CONNACK; success resets the delay
+        self._backoff()
+
+    # paho external event loop hooks: keep the selector registration in sync with the socket
+    def _on_socket_open(self, client, userdata, sock):
+        if sock.fileno() in self._sel.get_map():
+            # number reused from a socket closed behind the selector's back (e.g. a tcp MAVLink
+            # reconnect): drop the stale entry, the bridge re-registers its own fd on its next pass
+            self._sel.unregister(sock)
+        self._sel.register(sock, selectors.EVENT_READ, self.handle_io)
+
+    def _on_socket_close(self, client, userdata, sock):
+        self._sel.unregister(sock)
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._sel.modify(sock, selectors.EVENT_READ | selectors.EVENT_WRITE, self.handle_io)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._sel.modify(sock, selectors.EVENT_READ, self.handle_io)
 
-    def start(self):
-        # run loop_start (background thread)
+    def handle_io(self, mask):
+        """Selector callback for the broker socket."""
+        if mask & selectors.EVENT_READ:
+            self.client.loop_read()
+        if mask & selectors.EVENT_WRITE:
+            self.client.loop_write()
+
+    def tick(self):
+        """Keepalive and reconnect housekeeping; call at least once a second from the I/O loop."""
+        if self.client.loop_misc() == mqtt.MQTT_ERR_NO_CONN and time.monotonic() >= self._retry_at:
+            self._connect()
+
+    def _connect(self):
+        # blocking TCP (and TLS) connect; CONNACK arrives later through handle_io
         try:
-            self.client.connect(self.host, self.port, keepalive=60)
-        except Exception as e:
-            print(f"[mqtt] initial connect failed: {e}", file=sys.stderr)
-        self.client.loop_start()
+            self.client.reconnect()
+        except Exception as e:  # OSError, or a socket hook failing
+            log.warning("[mqtt] connect to %s:%s failed: %s (retry in %ds)", self.host, self.port, e, self._retry_delay)
+            self._backoff()
+
+    def _backoff(self):
+        # a refused CONNACK is followed by on_disconnect: count that attempt once
+        if time.monotonic() < self._retry_at:
+            return
+        self._retry_at = time.monotonic() + self._retry_delay
+        self._retry_delay = min(self._retry_delay * 2, RECONNECT_MAX_DELAY)
+
+    def start(self, sel):
+        """Connect; the broker socket is then serviced by `sel` on the caller's thread."""
+        self._sel = sel
+        log.info("[mqtt] connecting to %s:%s ...", self.host, self.port)
+        self.client.connect_async(self.host, self.port, keepalive=60)
+        self._connect()
 
     def stop(self):
         self._stop = True
         try:
-            self.client.loop_stop()
             self.client.disconnect()
+            self.client.loop_write()  # send DISCONNECT now, nothing services the socket after this
         except Exception:
             pass
 
-    def publish(self, topic, payload, qos=1):
-        if not self._connected.is_set():
-            # wait a small amount for connect
-            if not self._connected.wait(timeout=2.0):
-                # not connected -> still attempt publish (it will be queued locally)
-                print("[mqtt] warning: not connected, publishing will queue locally")
+    def publish(self, topic, payload, qos=0):
+        if not self.connected:
+            self._backlog.append((topic, payload, qos))
+            return
         try:
+            while self._backlog:
+                self.client.publish(*self._backlog.popleft())
             self.client.publish(topic, payload, qos=qos)
         except Exception as e:
-            print(f"[mqtt] publish exception: {e}", file=sys.stderr)
+            log.error("[mqtt] publish exception: %s", e)
 
 # -----------------------
 # Main bridge
 # -----------------------
-def bridge_loop(mav_uri, mqtt_cfg, topic, rate_hz, queue_size=100):
+def request_message_intervals(mav, rate_hz):
+    """Ask the autopilot to stream each telemetry message at rate_hz (rate limiting at the source)."""
+    interval_us = int(1e6 / max(0.1, rate_hz))  # avoid division by zero
+    for msg_id in TELEMETRY_MSG_IDS:
+        mav.mav.command_long_send(
+            mav.target_system, mav.target_component,
+            mavutil.mavlink.MAV_CMD_SET_MESSAGE_INTERVAL, 0,
+            msg_id, interval_us, 0, 0, 0, 0, 0)
+    log.info("[mav] requested %d telemetry streams at %g Hz", len(TELEMETRY_MSG_IDS), rate_hz)
+
+def bridge_loop(mav_uri, mqtt_cfg, topic, rate_hz, batch_n=1, batch_ms=0.0, qos=0, raw_udp=False):
     # Setup MAVLink connection (auto-reconnect)
-    print(f"[mav] connecting to {mav_uri} ...")
+    log.info("[mav] connecting to %s ...", mav_uri)
     mav = mavutil.mavlink_connection(mav_uri, autoreconnect=True, source_system=255)
-    print("[mav] waiting for first heartbeat (5s timeout)...")
+    log.info("[mav] waiting for first heartbeat (5s timeout)...")
     try:
         hb = mav.wait_heartbeat(timeout=5)
         if hb:
-            print("[mav] heartbeat received")
+            log.info("[mav] heartbeat received")
+            request_message_intervals(mav, rate_hz)
         else:
-            print("[mav] no heartbeat yet -- bridge will still attempt to read")
+            log.warning("[mav] no heartbeat yet -- bridge will still attempt to read (stream rates left as configured)")
     except Exception as e:
-        print(f"[mav] heartbeat wait error: {e}")
+        log.warning("[mav] heartbeat wait error: %s", e)
 
     mqttc = MQTTClient(**mqtt_cfg)
-    mqttc.start()
+    if qos > 0:
+        # don't let paho's default inflight window (20) throttle the stream
+        mqttc.client.max_inflight_messages_set(1000)
+    sel = selectors.DefaultSelector()
+    mqttc.start(sel)
 
     seq = 0
-    last_pub = 0.0
-    publish_interval = 1.0 / max(0.1, rate_hz)  # avoid division by zero
-    out_queue = Queue(maxsize=queue_size)
+    batch = bytearray(b"[")  # JSON array assembled in place, reused across flushes
+    batch_count = 0
+    batch_first = batch_last = 0  # seq range held in batch (the drain's seq may already be ahead)
+    batch_interval = batch_ms / 1000.0
+    last_flush = time.monotonic()
+    payloads = []
+
+    raw_sock = None
+    if raw_udp:
+        if isinstance(mav, mavutil.mavudp):
+            raw_sock = mav.port
+            log.info("[mav] raw UDP decoding enabled (CRC not checked)")
+        else:
+            log.warning("[mav] --raw-udp needs a udp connection -- falling back to pymavlink")
+
+    if mav.fd is None:
+        raise RuntimeError(f"{mav_uri} has no pollable file descriptor")
+    mav_fd = mav_port = None
+
+    def sync_mav_fd():
+        # tcp links swap mav.port/mav.fd on accept/reconnect: follow them or we wait on a dead fd.
+        # Compare the port object too, a reconnect can reuse the old fd number.
+        nonlocal mav_fd, mav_port
+        if mav.fd == mav_fd and getattr(mav, "port", None) is mav_port:
+            return
+        if mav_fd is not None:
+            key = sel.get_map().get(mav_fd)
+            if key is not None and key.data is None:  # number may already belong to the broker socket
+                sel.unregister(mav_fd)
+        mav_fd, mav_port = mav.fd, getattr(mav, "port", None)
+        if mav_fd is not None:
+            # data=None marks the MAVLink fd; the broker socket carries mqttc.handle_io
+            sel.register(mav_fd, selectors.EVENT_READ)
+
+    sync_mav_fd()
+
+    # everything below is fixed after parse_args: bind it once instead of re-checking per sample
+    send = functools.partial(mqttc.publish, topic, qos=qos)
+
+    def flush_batch():
+        nonlocal batch_count, last_flush
+        log.debug("[bridge] published batch n=%d seq=%d..%d", batch_count, batch_first, batch_last)
+        if batch_last // STATUS_EVERY > (batch_first - 1) // STATUS_EVERY:
+            log.info("[bridge] published %d samples", batch_last)
+        batch.extend(b"]")
+        # publish a snapshot: paho may still hold the payload (QoS>0 retries, offline backlog)
+        send(bytes(batch))
+        del batch[1:]
+        batch_count = 0
+        last_flush = time.monotonic()  # immune to wall-clock (NTP) steps
+
+    def publish_single(payload, seq, now):
+        send(payload)
+        log.debug("[bridge] published seq=%d t=%.3f", seq, now)
+        if seq % STATUS_EVERY == 0:
+            log.info("[bridge] published %d samples", seq)
+
+    def publish_batched(payload, seq, now):
+        # publish a JSON array once N samples are collected (batch_ms is checked by the loop)
+        nonlocal batch_count, batch_first, batch_last
+        if batch_count:
+            batch.extend(b",")
+        else:
+            batch_first = seq
+        batch.extend(payload)
+        batch_last = seq
+        batch_count += 1
+        if batch_count >= batch_n:
+            flush_batch()
 
-    def reader():
+    def drain_raw():
+        # bypass pymavlink: struct-decode the telemetry frames straight from each datagram
         nonlocal seq
-        while True:
+        for _ in range(MAX_DRAIN):
             try:
-                msg = mav.recv_match(blocking=True, timeout=2)
-                if msg is None:
-                    continue
-                # Build telemetry
-                seq += 1
-                telemetry = build_telemetry_from_msg(msg, seq)
-                if telemetry:
-                    # Compute a simple velocity fallback if not present and vx/vy available
-                    if "velocity" not in telemetry and ("vx" in telemetry or "vy" in telemetry):
-                        try:
-                            vx = telemetry.get("vx", 0) / 100.0  # cm/s -> m/s
-                            vy = telemetry.get("vy", 0) / 100.0
-                            telemetry["velocity"] = (vx*vx + vy*vy) ** 0.5
-                            # remove vx/vy to keep payload small
-                            telemetry.pop("vx", None); telemetry.pop("vy", None)
-                        except Exception:
-                            pass
-                    # push to queue (drop if full)
-                    try:
-                        out_queue.put_nowait(telemetry)
-                    except Exception:
-                        # queue full: drop oldest then push
-                        try:
-                            out_queue.get_nowait()
-                            out_queue.put_nowait(telemetry)
-                        except Exception:
-                            pass
-            except Exception as e:
-                print(f"[mav reader] error: {e}", file=sys.stderr)
-                time.sleep(1)
+                data = raw_sock.recv(mavutil.UDP_MAX_PACKET_LEN)
+            except (BlockingIOError, ConnectionRefusedError):
+                return False
+            now = time.time()
+            first = seq + 1
+            payloads.clear()
+            seq = decode_datagram(data, seq, now, payloads)
+            for s, payload in enumerate(payloads, first):
+                publish_sample(payload, s, now)
+        return True  # capped, more may be pending
 
-    reader_thread = threading.Thread(target=reader, daemon=True)
-    reader_thread.start()
+    def drain_pymavlink():
+        nonlocal seq
+        for _ in range(MAX_DRAIN):
+            # non-blocking: None once the socket and pymavlink's parse buffer are empty
+            msg = mav.recv_match(type=TELEMETRY_TYPES)
+            if msg is None:
+                return False
+            seq += 1
+            now = time.time()
+            payload = build_telemetry_from_msg(msg, seq, now)
+            if payload:
+                publish_sample(payload, seq, now)
+        return True  # capped, more may be pending (possibly only in pymavlink's buffer)
 
-    print("[bridge] entering publish loop")
+    publish_sample = publish_single if batch_n <= 1 else publish_batched
+    drain = drain_raw if raw_sock is not None else drain_pymavlink
+
+    log.info("[bridge] entering publish loop")
+    more = False
     try:
         while True:
             try:
-                telemetry = out_queue.get(timeout=1.0)
-            except Empty:
-                # allow graceful shutdown
-                time.sleep(0.01)
-                continue
-
-            now = time.time()
-            if now - last_pub < publish_interval:
-                # rate limiting: if too soon, drop/skip this sample
-                # optionally we could re-queue; here we skip to keep latency low
-                continue
-
-            payload = json.dumps(telemetry, separators=(",", ":"), sort_keys=True)
-            mqttc.publish(topic, payload)
-            last_pub = now
-            # tiny status print
-            print(f"[bridge] published seq={telemetry.get('seq')} t={telemetry.get('timestamp'):.3f}")
+                # single thread: MAVLink input and MQTT socket I/O share one selector.
+                # Each pass drains at most MAX_DRAIN samples; if that left input behind,
+                # poll without waiting and drain again after the broker socket is serviced.
+                timeout = 1.0
+                if more:
+                    timeout = 0.0
+                elif batch_count and batch_interval:
+                    timeout = max(0.0, last_flush + batch_interval - time.monotonic())
+                readable = more
+                for key, mask in sel.select(timeout):
+                    if key.data is None:
+                        readable = True
+                    else:
+                        key.data(mask)
+                more = drain() if readable else False
+                sync_mav_fd()  # after a drain or a timeout
+                mqttc.tick()
+                if batch_count and batch_interval and time.monotonic() - last_flush >= batch_interval:
+                    flush_batch()
+            except Exception as e:
+                log.error("[bridge] error: %s", e)
+                time.sleep(1)
     except KeyboardInterrupt:
-        print("[bridge] interrupted by user")
+        log.info("[bridge] interrupted by user")
     finally:
+        if batch_count:
+            flush_batch()
         mqttc.stop()
-        print("[bridge] stopped")
+        sel.close()
+        log.info("[bridge] stopped")
 
 # -----------------------
 # CLI
@@ -257,8 +389,13 @@ def parse_args():
     p.add_argument("--tls-cert", default=None, help="Path to client cert (optional)")
     p.add_argument("--tls-key", default=None, help="Path to client key (optional)")
     p.add_argument("--topic", default=DEFAULT_TOPIC)
-    p.add_argument("--rate", default=DEFAULT_RATE, type=float, help="Maximum publish rate (Hz)")
-    p.add_argument("--queue-size", default=200, type=int, help="Telemetry queue size")
+    p.add_argument("--qos", default=0, type=int, choices=(0, 1, 2), help="MQTT QoS for telemetry (0 = fire-and-forget)")
+    p.add_argument("--rate", default=DEFAULT_RATE, type=float, help="Stream rate requested from the autopilot for each telemetry message (Hz)")
+    p.add_argument("--batch", default=1, type=int, help="Samples per MQTT message; >1 publishes a JSON array")
+    p.add_argument("--batch-ms", default=0.0, type=float, help="Flush a partial batch after this many ms (0 = only when full)")
+    p.add_argument("--raw-udp", action="store_true", help="Decode telemetry frames from the UDP socket directly instead of via pymavlink (no CRC check; trusted/loopback links only)")
+    p.add_argument("--queue-size", default=200, type=int, help="Samples kept while the broker is unreachable (oldest dropped first)")
+    p.add_argument("-v", "--verbose", action="store_true", help="Log every published sample (DEBUG)")
     return p.parse_args()
 
 def read_password(file_path):
@@ -268,11 +405,12 @@ def read_password(file_path):
         with open(file_path, "r") as f:
             return f.read().strip()
     except Exception as e:
-        print(f"[args] failed reading password file: {e}", file=sys.stderr)
+        log.error("[args] failed reading password file: %s", e)
         return None
 
 def main():
     args = parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format="%(message)s")
     mqtt_password = read_password(args.mqtt_pass_file)
 
     mqtt_cfg = {
@@ -283,12 +421,14 @@ def main():
         "tls_ca": args.tls_ca,
         "tls_cert": args.tls_cert,
         "tls_key": args.tls_key,
+        "queue_size": args.queue_size,
     }
 
     try:
-        bridge_loop(args.mav, mqtt_cfg, args.topic, args.rate, queue_size=args.queue_size)
+        bridge_loop(args.mav, mqtt_cfg, args.topic, args.rate,
+                    batch_n=args.batch, batch_ms=args.batch_ms, qos=args.qos, raw_udp=args.raw_udp)
     except Exception as e:
-        print(f"[main] fatal error: {e}", file=sys.stderr)
+        log.critical("[main] fatal error: %s", e)
         sys.exit(1)
 
 if __name__ == "__main__":
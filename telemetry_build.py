@@ -0,0 +1,132 @@
+"""
+telemetry_build.py
+
+MAVLink message -> JSON payload builders used by mav_to_mqtt.py.
+
+Kept in a separate, type-annotated module so it can optionally be compiled
+to a C extension with mypyc; mav_to_mqtt.py imports whichever is present
+(the compiled .so takes precedence over this file):
+
+    pip install mypy
+    mypyc telemetry_build.py
+"""
+
+import math
+import struct
+from typing import Any, Callable, Dict, List, Optional, Set
+
+# Payloads are formatted straight into pre-serialized JSON templates (keys
+# sorted, compact separators) -- no per-sample dict and no JSON encoder.
+_TMPL_GPI = b'{"alt":%.3f,"hdg":%.2f,"lat":%.7f,"lon":%.7f,"relative_alt":%.3f,"seq":%d,"timestamp":%.6f,"vx":%d,"vy":%d,"vz":%d}'
+_TMPL_VFR = b'{"airspeed":%b,"alt":%b,"groundspeed":%b,"seq":%d,"throttle":%d,"timestamp":%.6f}'
+_TMPL_GPS = b'{"alt":%.3f,"eph":%d,"epv":%d,"lat":%.7f,"lon":%.7f,"seq":%d,"timestamp":%.6f}'
+
+def _json_float(x: float) -> bytes:
+    # NaN/inf (e.g. no airspeed sensor) are not valid JSON
+    return b"%.3f" % x if math.isfinite(x) else b"null"
+
+def _format_gpi(lat: int, lon: int, alt: int, relative_alt: int, vx: int, vy: int, vz: int, hdg: int,
+                seq: int, now: float) -> bytes:
+    # lat/lon are integers scaled by 1e7; alt in mm; hdg in cdeg; vx/vy/vz passed through in cm/s
+    # (ground speed is published by VFR_HUD, so no derived velocity here)
+    return _TMPL_GPI % (
+        alt / 1000.0, hdg / 100.0, lat / 1e7, lon / 1e7,
+        relative_alt / 1000.0, seq, now, vx, vy, vz)
+
+def _format_vfr(airspeed: float, alt: float, groundspeed: float, throttle: int, seq: int, now: float) -> bytes:
+    # alt in m, speeds in m/s, throttle in %
+    return _TMPL_VFR % (
+        _json_float(airspeed), _json_float(alt), _json_float(groundspeed), seq, throttle, now)
+
+def _format_gps(lat: int, lon: int, alt: int, eph: int, epv: int, seq: int, now: float) -> bytes:
+    return _TMPL_GPS % (alt / 1000.0, eph, epv, lat / 1e7, lon / 1e7, seq, now)
+
+# -----------------------
+# pymavlink messages
+# -----------------------
+def _build_gpi(msg: Any, seq: int, now: float) -> bytes:
+    return _format_gpi(msg.lat, msg.lon, msg.alt, msg.relative_alt, msg.vx, msg.vy, msg.vz, msg.hdg, seq, now)
+
+def _build_vfr(msg: Any, seq: int, now: float) -> bytes:
+    return _format_vfr(msg.airspeed, msg.alt, msg.groundspeed, msg.throttle, seq, now)
+
+def _build_gps(msg: Any, seq: int, now: float) -> bytes:
+    return _format_gps(msg.lat, msg.lon, msg.alt, msg.eph, msg.epv, seq, now)
+
+_BUILDERS: Dict[str, Callable[[Any, int, float], bytes]] = {
+    "GLOBAL_POSITION_INT": _build_gpi,
+    "VFR_HUD": _build_vfr,
+    "GPS_RAW_INT": _build_gps,
+}
+TELEMETRY_TYPES: Set[str] = set(_BUILDERS)  # recv_match accepts a list or set, not a frozenset
+
+def build_telemetry_from_msg(msg: Any, seq: int, now: float) -> Optional[bytes]:
+    """Return the JSON payload (bytes) or None if msg not relevant. `now` is the sample's wall-clock timestamp."""
+    builder = _BUILDERS.get(msg.get_type())
+    return builder(msg, seq, now) if builder else None
+
+# -----------------------
+# raw MAVLink frames
+# -----------------------
+# Wire layouts of the base (non-extension) payload fields, largest type first.
+_GPI = struct.Struct("<IiiiihhhH")   # time_boot_ms, lat, lon, alt, relative_alt, vx, vy, vz, hdg
+_VFR = struct.Struct("<ffffhH")      # airspeed, groundspeed, alt, climb, heading, throttle
+_GPS = struct.Struct("<QiiiHHHHBB")  # time_usec, lat, lon, alt, eph, epv, vel, cog, fix_type, satellites_visible
+
+def _padded(payload: bytes, size: int) -> bytes:
+    # MAVLink 2 strips trailing zero bytes from the payload
+    n = len(payload)
+    return payload if n >= size else payload + bytes(size - n)
+
+def _raw_gpi(payload: bytes, seq: int, now: float) -> bytes:
+    _, lat, lon, alt, relative_alt, vx, vy, vz, hdg = _GPI.unpack_from(_padded(payload, _GPI.size))
+    return _format_gpi(lat, lon, alt, relative_alt, vx, vy, vz, hdg, seq, now)
+
+def _raw_vfr(payload: bytes, seq: int, now: float) -> bytes:
+    airspeed, groundspeed, alt, _, _, throttle = _VFR.unpack_from(_padded(payload, _VFR.size))
+    return _format_vfr(airspeed, alt, groundspeed, throttle, seq, now)
+
+def _raw_gps(payload: bytes, seq: int, now: float) -> bytes:
+    _, lat, lon, alt, eph, epv, _, _, _, _ = _GPS.unpack_from(_padded(payload, _GPS.size))
+    return _format_gps(lat, lon, alt, eph, epv, seq, now)
+
+_RAW_DECODERS: Dict[int, Callable[[bytes, int, float], bytes]] = {
+    33: _raw_gpi,  # GLOBAL_POSITION_INT
+    74: _raw_vfr,  # VFR_HUD
+    24: _raw_gps,  # GPS_RAW_INT
+}
+
+def decode_datagram(data: bytes, seq: int, now: float, out: List[bytes]) -> int:
+    """Append a JSON payload to `out` for every telemetry frame in a raw MAVLink
+    UDP datagram and return the last seq used. Other messages are skipped.
+    CRC and signatures are NOT checked -- meant for a trusted (loopback) link."""
+    i = 0
+    n = len(data)
+    while i < n:
+        stx = data[i]
+        if stx == 0xFD:  # MAVLink 2: stx len incompat compat seq sys comp msgid[3]
+            if i + 10 > n:
+                break
+            plen = data[i + 1]
+            msg_id = data[i + 7] | data[i + 8] << 8 | data[i + 9] << 16
+            start = i + 10
+            end = start + plen + 2 + (13 if data[i + 2] & 0x01 else 0)  # crc + optional signature
+        elif stx == 0xFE:  # MAVLink 1: stx len seq sys comp msgid
+            if i + 6 > n:
+                break
+            plen = data[i + 1]
+            msg_id = data[i + 5]
+            start = i + 6
+            end = start + plen + 2
+        else:
+            # not at a frame boundary: resync on the next byte
+            i += 1
+            continue
+        if end > n:
+            break
+        decode = _RAW_DECODERS.get(msg_id)
+        if decode is not None:
+            seq += 1
+            out.append(decode(data[start:start + plen], seq, now))
+        i = end
+    return seq